@@ -1,54 +1,273 @@
-import logging
-import os
 import asyncio
-from flask import Flask, request, jsonify
-from telegram import Update
+import atexit
+import hmac
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import stripe
+from flask import Blueprint, Flask, Response, request
+from flask.json.provider import JSONProvider
+
+from components import (
+    get_db,
+    get_openai_handler,
+    get_scheduler,
+    get_stripe_handler,
+    get_telegram_bot,
+)
+from config import get_settings, validate_config
+from logging_setup import configure_logging
+from telegram_bot import HANDLED_UPDATE_TYPES
 
-from database import SupabaseDB
-from openai_handler import OpenAIHandler
-from stripe_handler import StripeHandler
-from telegram_bot import TelegramBot
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - uvloop is not available on Windows
+    uvloop = None
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger("app")
 
+validate_config()
+settings = get_settings()
+
+
+class OrjsonProvider(JSONProvider):
+    """Route Flask's request.get_json/jsonify through orjson."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=kwargs.get("default")).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Telegram's webhook lives on its own blueprint so only it waits on bot bootstrap;
+# static/health routes and the Stripe webhook never depend on Telegram being up.
+webhooks = Blueprint("webhooks", __name__)
+
+# --- Background event loop for Telegram update processing ---
+bot_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+# Blocking Supabase/Stripe/OpenAI calls are offloaded here via asyncio.to_thread.
+bot_loop.set_default_executor(
+    ThreadPoolExecutor(max_workers=settings.thread_pool_size, thread_name_prefix="biteiq-io")
+)
+
+
+def bot_loop_runner():
+    asyncio.set_event_loop(bot_loop)
+    bot_loop.run_forever()
+
+
+threading.Thread(target=bot_loop_runner, name="bot-loop", daemon=True).start()
 
-# --- Instantiate bot components ---
-db = SupabaseDB()
-openai_handler = OpenAIHandler()
-stripe_handler = StripeHandler()
-telegram_bot = TelegramBot(db, openai_handler, stripe_handler)
+# --- Initialize Telegram bot once per process ---
+_bootstrap_lock = threading.Lock()
+_bootstrap_done = threading.Event()
 
-# --- Initialize Telegram bot once ---
-@app.before_first_request
+
+async def _check_database():
+    # A slow Supabase must not stall worker boot; the first real query will surface errors.
+    try:
+        await asyncio.wait_for(asyncio.to_thread(get_db().check_connection), timeout=3.0)
+        logger.info("✅ Supabase connection established")
+    except Exception as exc:
+        logger.warning("⚠️ Supabase connection check failed: %r", exc)
+
+
+async def _startup():
+    # Components are built lazily by the factories; bootstrap is where they first get touched.
+    await _check_database()
+    telegram_bot = get_telegram_bot()
+    await telegram_bot.initialize()
+    await telegram_bot.warm_up()
+    get_scheduler(bot_loop).start()
+
+
+def bootstrap():
+    """Start the bot and scheduler on bot_loop. Called from gunicorn's post_worker_init hook."""
+    if _bootstrap_done.is_set():
+        return
+    with _bootstrap_lock:
+        if _bootstrap_done.is_set():
+            return
+        asyncio.run_coroutine_threadsafe(_startup(), bot_loop).result()
+        _bootstrap_done.set()
+
+
+async def _shutdown():
+    get_scheduler(bot_loop).shutdown()
+    await get_telegram_bot().shutdown()
+    openai_handler = get_openai_handler()
+    openai_handler.close()
+    await openai_handler.aclose()
+
+
+def _stop_bot_loop():
+    if _bootstrap_done.is_set():
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), bot_loop).result(timeout=10)
+        except Exception as exc:
+            logger.warning("⚠️ Bot shutdown did not complete cleanly: %r", exc)
+    bot_loop.call_soon_threadsafe(bot_loop.stop)
+
+
+atexit.register(_stop_bot_loop)
+
+
+@webhooks.before_request
 def init_bot():
-    asyncio.run(telegram_bot.initialize())
+    # No-op once booted; covers `python app.py`, servers without the gunicorn hook, and a
+    # post_worker_init bootstrap that failed (e.g. Telegram unreachable during a deploy).
+    bootstrap()
+
+
+# --- Static pages (built once, served as-is) ---
+def _static_page(html: str) -> Response:
+    response = Response(html.encode("utf-8"), mimetype="text/html")
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+
+def _static_json(payload: dict) -> Response:
+    return Response(orjson.dumps(payload), mimetype="application/json")
+
+
+_INDEX_RESPONSE = _static_json({"message": "running on Render", "service": "BiteIQBot", "status": "ok"})
+_HEALTH_RESPONSE = _static_json({"status": "healthy"})
+_PAYMENT_SUCCESS_PAGE = _static_page(
+    "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>BiteIQ</title></head>"
+    "<body style=\"font-family:sans-serif;text-align:center;padding:40px\">"
+    "<h1>✅ Payment successful</h1>"
+    "<p>Your BiteIQ subscription is active. You can return to Telegram now.</p>"
+    "</body></html>"
+)
+_PAYMENT_CANCELLED_PAGE = _static_page(
+    "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>BiteIQ</title></head>"
+    "<body style=\"font-family:sans-serif;text-align:center;padding:40px\">"
+    "<h1>Payment cancelled</h1>"
+    "<p>No charge was made. You can subscribe anytime from the bot menu.</p>"
+    "</body></html>"
+)
 
 
 @app.route("/", methods=["GET"])
 def index():
-    return jsonify({"message": "running on Render", "service": "BiteIQBot", "status": "ok"}), 200
+    return _INDEX_RESPONSE
+
+
+@app.route("/health", methods=["GET"])
+def health_check():
+    return _HEALTH_RESPONSE
+
+
+@app.route("/payment-success", methods=["GET"])
+def payment_success():
+    return _PAYMENT_SUCCESS_PAGE
+
+
+@app.route("/payment-cancelled", methods=["GET"])
+def payment_cancelled():
+    return _PAYMENT_CANCELLED_PAGE
+
+
+# --- Retry dedupe (Telegram update_id, Stripe event id) ---
+_SEEN_DELIVERIES_MAX = 10_000
+
+
+class _DeliveryLog:
+    """Bounded, thread-safe record of recently accepted delivery ids."""
 
+    def __init__(self, max_size: int = _SEEN_DELIVERIES_MAX):
+        self._seen: "OrderedDict[object, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_size = max_size
 
-@app.route("/webhook", methods=["POST"])
+    def first(self, delivery_id) -> bool:
+        """Return False if this id was already accepted (a provider retry)."""
+        if delivery_id is None:
+            return True
+        with self._lock:
+            if delivery_id in self._seen:
+                return False
+            self._seen[delivery_id] = None
+            if len(self._seen) > self._max_size:
+                self._seen.popitem(last=False)
+        return True
+
+    def forget(self, delivery_id) -> None:
+        with self._lock:
+            self._seen.pop(delivery_id, None)
+
+
+_telegram_deliveries = _DeliveryLog()
+_stripe_deliveries = _DeliveryLog()
+
+
+@webhooks.route("/webhook", methods=["POST"])
 def webhook():
     """Handle Telegram webhook updates."""
+    if settings.telegram_webhook_secret and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+        settings.telegram_webhook_secret,
+    ):
+        return "Unauthorized", 401
+
     try:
-        data = request.get_json(force=True)
-        logger.info(f"📩 Incoming Telegram update: {data}")
+        data = orjson.loads(request.get_data(cache=False))
+        logger.debug("📩 Telegram update id=%s", data.get("update_id"))
+        if HANDLED_UPDATE_TYPES.isdisjoint(data):
+            # Nothing would handle it; skip building the Update object graph.
+            return "OK", 200
+        if not _telegram_deliveries.first(data.get("update_id")):
+            return "OK", 200
 
-        update = Update.de_json(data, telegram_bot.application.bot)
-        asyncio.run(telegram_bot.application.process_update(update))
+        if not get_telegram_bot().enqueue_update_json(data):
+            # Backpressure: Telegram redelivers later. Forget the id so the retry is accepted.
+            _telegram_deliveries.forget(data.get("update_id"))
+            logger.warning("⚠️ Update queue full; asking Telegram to retry")
+            return "Busy", 503
 
-        logger.info("✅ Processed Telegram update successfully")
-        return jsonify({"ok": True}), 200
+        return "OK", 200
     except Exception as e:
         logger.exception("❌ Telegram webhook error: %s", e)
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return app.json.response({"ok": False, "error": str(e)}), 500
+
+
+@app.route("/stripe-webhook", methods=["POST"])
+def stripe_webhook():
+    """Verify and apply Stripe webhooks inline so failures are retried by Stripe."""
+    stripe_handler = get_stripe_handler()
+    payload = request.get_data(cache=False)
+    signature = request.headers.get("Stripe-Signature", "")
+    try:
+        event = stripe_handler.construct_event(payload, signature)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.warning("⚠️ Rejected Stripe webhook: %s", e)
+        return app.json.response({"error": str(e)}), 400
+
+    if not stripe_handler.handles(event.get("type")) or not _stripe_deliveries.first(event.get("id")):
+        return "OK", 200
+
+    # Applied before acknowledging: Stripe only redelivers after a non-2xx response, so a
+    # failure here must surface as 500 and drop the id from the dedupe log.
+    try:
+        stripe_handler.handle_webhook_event(event)
+    except Exception as e:
+        _stripe_deliveries.forget(event.get("id"))
+        logger.exception("❌ Stripe event processing failed: %s", e)
+        return app.json.response({"error": "processing failed"}), 500
+    return "OK", 200
+
+
+app.register_blueprint(webhooks)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
+    app.run(host="0.0.0.0", port=settings.port)
 
 
@@ -0,0 +1,43 @@
+import asyncio
+from functools import lru_cache
+
+from database import SupabaseDB
+from openai_handler import OpenAIHandler
+from scheduler import Scheduler
+from stripe_handler import StripeHandler
+from telegram_bot import TelegramBot
+
+__all__ = [
+    "get_db",
+    "get_openai_handler",
+    "get_scheduler",
+    "get_stripe_handler",
+    "get_telegram_bot",
+]
+
+
+# Built on first use and shared for the life of the process, so importing app
+# never opens network clients and each component is constructed exactly once.
+@lru_cache(maxsize=1)
+def get_db() -> SupabaseDB:
+    return SupabaseDB()
+
+
+@lru_cache(maxsize=1)
+def get_openai_handler() -> OpenAIHandler:
+    return OpenAIHandler(get_db())
+
+
+@lru_cache(maxsize=1)
+def get_stripe_handler() -> StripeHandler:
+    return StripeHandler(get_db())
+
+
+@lru_cache(maxsize=1)
+def get_telegram_bot() -> TelegramBot:
+    return TelegramBot(get_db(), get_openai_handler(), get_stripe_handler())
+
+
+@lru_cache(maxsize=1)
+def get_scheduler(event_loop: asyncio.AbstractEventLoop) -> Scheduler:
+    return Scheduler(get_db(), get_openai_handler(), get_telegram_bot(), event_loop=event_loop)
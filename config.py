@@ -1,47 +1,75 @@
 import os
-from typing import List
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 
 from dotenv import load_dotenv
 
-load_dotenv()
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
-STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID", "price_default")
-SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
-WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://example.com")
-PORT = int(os.getenv("PORT", 8080))
+@dataclass(frozen=True, slots=True)
+class Settings:
+    telegram_bot_token: Optional[str]
+    telegram_webhook_secret: Optional[str]
+    openai_api_key: Optional[str]
+    openai_model: str
+    openai_rpm: int
+    openai_tpm: int
+    stripe_secret_key: Optional[str]
+    stripe_webhook_secret: Optional[str]
+    stripe_price_id: str
+    supabase_url: Optional[str]
+    supabase_service_key: Optional[str]
+    webhook_url: str
+    render_external_url: str
+    port: int
+    thread_pool_size: int
+    supabase_pool_size: int
+    log_level: str
 
 
-def validate_config() -> List[str]:
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    load_dotenv()
+    return Settings(
+        telegram_bot_token=os.getenv("TELEGRAM_BOT_TOKEN"),
+        telegram_webhook_secret=os.getenv("TELEGRAM_WEBHOOK_SECRET"),
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        openai_model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        openai_rpm=int(os.getenv("OPENAI_RPM", 500)),
+        openai_tpm=int(os.getenv("OPENAI_TPM", 200_000)),
+        stripe_secret_key=os.getenv("STRIPE_SECRET_KEY"),
+        stripe_webhook_secret=os.getenv("STRIPE_WEBHOOK_SECRET"),
+        stripe_price_id=os.getenv("STRIPE_PRICE_ID", "price_default"),
+        supabase_url=os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL"),
+        supabase_service_key=os.getenv("SUPABASE_SERVICE_KEY"),
+        webhook_url=os.getenv("WEBHOOK_URL", "https://example.com"),
+        render_external_url=os.getenv(
+            "RENDER_EXTERNAL_URL", "https://biteiqbot-docker.onrender.com"
+        ).rstrip("/"),
+        port=int(os.getenv("PORT", 8080)),
+        thread_pool_size=int(os.getenv("THREAD_POOL_SIZE", 64)),
+        supabase_pool_size=int(os.getenv("SUPABASE_POOL_SIZE", 10)),
+        log_level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    )
+
+
+def validate_config() -> None:
+    settings = get_settings()
     required = {
-        "TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN,
-        "OPENAI_API_KEY": OPENAI_API_KEY,
-        "STRIPE_SECRET_KEY": STRIPE_SECRET_KEY,
-        "STRIPE_WEBHOOK_SECRET": STRIPE_WEBHOOK_SECRET,
-        "SUPABASE_URL": SUPABASE_URL,
-        "SUPABASE_SERVICE_KEY": SUPABASE_SERVICE_KEY,
+        "TELEGRAM_BOT_TOKEN": settings.telegram_bot_token,
+        "OPENAI_API_KEY": settings.openai_api_key,
+        "STRIPE_SECRET_KEY": settings.stripe_secret_key,
+        "STRIPE_WEBHOOK_SECRET": settings.stripe_webhook_secret,
+        "SUPABASE_URL": settings.supabase_url,
+        "SUPABASE_SERVICE_KEY": settings.supabase_service_key,
     }
     missing = [key for key, value in required.items() if not value]
     if missing:
-        print(f"Missing configuration keys: {', '.join(missing)}")
-    return missing
+        raise RuntimeError(f"Missing configuration keys: {', '.join(missing)}")
 
 
 __all__ = [
-    "TELEGRAM_BOT_TOKEN",
-    "OPENAI_API_KEY",
-    "OPENAI_MODEL",
-    "STRIPE_SECRET_KEY",
-    "STRIPE_WEBHOOK_SECRET",
-    "STRIPE_PRICE_ID",
-    "SUPABASE_URL",
-    "SUPABASE_SERVICE_KEY",
-    "WEBHOOK_URL",
-    "PORT",
+    "Settings",
+    "get_settings",
     "validate_config",
 ]
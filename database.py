@@ -1,44 +1,155 @@
-import json
 import logging
-import os
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import httpx
+from cachetools import TTLCache
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
 from supabase import Client, create_client
+from supabase.lib.client_options import ClientOptions
 
-SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+from config import get_settings
+
+settings = get_settings()
 
 _logger = logging.getLogger(__name__)
 
 
 # Render occasionally injects a proxy argument that breaks httpx; guard against it.
+# The same hook bounds the PostgREST session's keep-alive pool and turns on HTTP/2,
+# which supabase-py gives no other way to configure. Only clients pointed at our
+# Supabase project get those defaults; OpenAI's and PTB's clients are left alone.
 _original_httpx_client_init = httpx.Client.__init__
 
 
+def _is_supabase_session(base_url: Any) -> bool:
+    return bool(settings.supabase_url) and str(base_url or "").startswith(
+        settings.supabase_url.rstrip("/")
+    )
+
+
 def _safe_httpx_init(self, *args, **kwargs):
     kwargs.pop("proxy", None)
+    if _is_supabase_session(kwargs.get("base_url")):
+        kwargs.setdefault(
+            "limits",
+            httpx.Limits(
+                max_connections=settings.supabase_pool_size,
+                max_keepalive_connections=settings.supabase_pool_size,
+                keepalive_expiry=30,
+            ),
+        )
+        # Lets concurrent PostgREST calls from the executor share one TLS connection.
+        kwargs.setdefault("http2", True)
     return _original_httpx_client_init(self, *args, **kwargs)
 
 
 httpx.Client.__init__ = _safe_httpx_init
 
 
+class CircuitOpenError(Exception):
+    """Raised instead of calling Supabase while the circuit breaker is open."""
+
+
+class _CircuitBreaker:
+    """Fail fast after repeated outages.
+
+    Only the state bookkeeping is locked; the wrapped call runs outside the lock so
+    concurrent queries are not serialized behind each other.
+    """
+
+    def __init__(self, fail_max: int, reset_timeout: float, exclude: Tuple[type, ...] = ()):
+        self._fail_max = fail_max
+        self._reset_timeout = reset_timeout
+        self._exclude = exclude
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def call(self, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            if (
+                self._opened_at is not None
+                and time.monotonic() - self._opened_at < self._reset_timeout
+            ):
+                raise CircuitOpenError("Supabase circuit breaker is open")
+        try:
+            result = func()
+        except self._exclude:
+            self._record_success()
+            raise
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return result
+
+    def _record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def _record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            # Also re-opens after a failed trial call once reset_timeout has passed.
+            if self._failures >= self._fail_max:
+                self._opened_at = time.monotonic()
+
+
+# Stop hammering Supabase while it is unreachable. APIError means PostgREST answered,
+# so it does not count as an outage.
+_breaker = _CircuitBreaker(fail_max=5, reset_timeout=30, exclude=(APIError,))
+
+
+def _execute(query: Any) -> Any:
+    return _breaker.call(query.execute)
+
+
+MEAL_HISTORY_BATCH_SIZE = 500
+
+_client: Optional[Client] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> Client:
+    """Return the process-wide Supabase client so every SupabaseDB shares one pool."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # postgrest always passes its own timeout (120s by default), so it has to be
+                # set here rather than in the httpx hook.
+                _client = create_client(
+                    settings.supabase_url,
+                    settings.supabase_service_key,
+                    options=ClientOptions(
+                        postgrest_client_timeout=httpx.Timeout(10.0, connect=2.0)
+                    ),
+                )
+    return _client
+
+
 class SupabaseDB:
     def __init__(self) -> None:
-        if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        if not settings.supabase_url or not settings.supabase_service_key:
             raise ValueError(
                 "SUPABASE_URL/VITE_SUPABASE_URL and SUPABASE_SERVICE_KEY must be set."
             )
 
-        self.client: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+        self.client: Client = _get_client()
+        # Nearly every helper starts by resolving telegram_id -> users row.
+        self._user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+        self._user_cache_lock = threading.Lock()
 
     # ------------------------------------------------------------------
     # Connection helpers
     # ------------------------------------------------------------------
     def check_connection(self) -> None:
-        self.client.table("users").select("id").limit(1).execute()
+        _execute(self.client.table("users").select("id").limit(1))
 
     # ------------------------------------------------------------------
     # User helpers
@@ -46,112 +157,181 @@ class SupabaseDB:
     def get_or_create_user(
         self, telegram_id: int, username: Optional[str] = None
     ) -> Dict[str, Any]:
-        user = self.get_user(telegram_id)
-        if user:
-            return user
-        return self.create_user(telegram_id, username)
+        with self._user_cache_lock:
+            cached = self._user_cache.get(telegram_id)
+        if cached is not None:
+            return cached
+
+        # One INSERT ... ON CONFLICT round-trip for both new and returning users;
+        # created_at keeps its column default, username is only written when known.
+        payload: Dict[str, Any] = {
+            "telegram_id": telegram_id,
+            "last_active": datetime.utcnow().isoformat(),
+        }
+        if username is not None:
+            payload["username"] = username
+        response = _execute(
+            self.client.table("users").upsert(payload, on_conflict="telegram_id")
+        )
+        if not getattr(response, "data", None):
+            return payload
+        self._cache_user(telegram_id, response.data[0])
+        return response.data[0]
 
     def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
-        response = (
+        with self._user_cache_lock:
+            cached = self._user_cache.get(telegram_id)
+        if cached is not None:
+            return cached
+
+        response = _execute(
             self.client.table("users")
             .select("*")
             .eq("telegram_id", telegram_id)
             .maybe_single()
-            .execute()
         )
-        return response.data if getattr(response, "data", None) else None
+        user = response.data if getattr(response, "data", None) else None
+        if user:
+            self._cache_user(telegram_id, user)
+        return user
+
+    def _cache_user(self, telegram_id: int, user: Dict[str, Any]) -> None:
+        with self._user_cache_lock:
+            self._user_cache[telegram_id] = user
+
+    def _invalidate_user(self, telegram_id: int) -> None:
+        with self._user_cache_lock:
+            self._user_cache.pop(telegram_id, None)
 
     def create_user(
         self, telegram_id: int, username: Optional[str] = None
     ) -> Dict[str, Any]:
+        now = datetime.utcnow().isoformat()
         payload = {
             "telegram_id": telegram_id,
             "username": username,
-            "created_at": datetime.utcnow().isoformat(),
-            "last_active": datetime.utcnow().isoformat(),
+            "created_at": now,
+            "last_active": now,
         }
-        response = self.client.table("users").insert(payload).execute()
-        return response.data[0] if getattr(response, "data", None) else payload
+        response = _execute(self.client.table("users").insert(payload))
+        if getattr(response, "data", None):
+            self._cache_user(telegram_id, response.data[0])
+            return response.data[0]
+        return payload
 
     def update_user(self, telegram_id: int, **fields: Any) -> None:
         if not fields:
             return
         fields["last_active"] = datetime.utcnow().isoformat()
-        self.client.table("users").update(fields).eq("telegram_id", telegram_id).execute()
+        _execute(
+            self.client.table("users")
+            .update(fields, returning=ReturnMethod.minimal)
+            .eq("telegram_id", telegram_id)
+        )
+        self._invalidate_user(telegram_id)
 
     def get_all_users(self) -> List[Dict[str, Any]]:
-        response = self.client.table("users").select("*").execute()
+        response = _execute(self.client.table("users").select("*"))
         return response.data or []
 
+    def get_subscribed_users(self) -> List[Dict[str, Any]]:
+        """Users with a live subscription, resolved in one joined query."""
+        response = _execute(
+            self.client.table("users")
+            .select("*, subscriptions!inner(status, current_period_end)")
+            .in_("subscriptions.status", ["active", "trialing"])
+        )
+        now = datetime.now(timezone.utc)
+        users: List[Dict[str, Any]] = []
+        for row in response.data or []:
+            subscriptions = row.pop("subscriptions", None) or []
+            # Same rule as the has_active_subscription SQL function.
+            if any(
+                not sub.get("current_period_end")
+                or datetime.fromisoformat(sub["current_period_end"]) > now
+                for sub in subscriptions
+            ):
+                users.append(row)
+        with self._user_cache_lock:
+            for user in users:
+                self._user_cache[user["telegram_id"]] = user
+        return users
+
     # ------------------------------------------------------------------
     # Meal plans / history
     # ------------------------------------------------------------------
-    def save_plan(self, telegram_id: int, day_label: str, plan_json: Dict[str, Any]) -> None:
-        user = self.get_user(telegram_id)
-        if not user:
-            return
-
-        payload = {
-            "user_id": user.get("id"),
-            "plan_day_label": day_label,
-            "plan_json": json.dumps(plan_json),
-            "updated_at": datetime.utcnow().isoformat(),
-        }
-        self.client.table("plans").upsert(payload).execute()
+    def save_plan(self, telegram_id: int, plan_date: str, plan_json: Dict[str, Any]) -> bool:
+        # Resolves the user and upserts on (user_id, plan_date) in one statement; the RPC
+        # returns a boolean because postgrest-py cannot parse the empty 204 of a void one.
+        response = _execute(
+            self.client.rpc(
+                "save_plan",
+                {"p_telegram_id": telegram_id, "p_plan_date": plan_date, "p_plan_json": plan_json},
+            )
+        )
+        return bool(response.data)
 
     def get_recent_meals(self, telegram_id: int, limit: int = 10) -> List[str]:
-        user = self.get_user(telegram_id)
-        if not user:
-            return []
-
-        response = (
-            self.client.table("meal_history")
-            .select("meal_title")
-            .eq("user_id", user.get("id"))
-            .order("seen_on", desc=True)
-            .limit(limit)
-            .execute()
-        )
-        titles = [row.get("meal_title") for row in (response.data or []) if row.get("meal_title")]
-        # dedupe while preserving order
-        seen: List[str] = []
-        for title in titles:
-            if title not in seen:
-                seen.append(title)
-        return seen
+        # Distinct titles from the latest `limit` rows, newest first, deduped in Postgres.
+        response = _execute(
+            self.client.rpc(
+                "recent_meal_titles", {"p_telegram_id": telegram_id, "p_limit": limit}
+            )
+        )
+        return response.data or []
 
     def add_meals_to_history(self, telegram_id: int, meals: List[str]) -> None:
         user = self.get_user(telegram_id)
         if not user or not meals:
             return
+        self.insert_meal_history(self.meal_history_rows(user.get("id"), meals))
 
-        rows = [
-            {
-                "user_id": user.get("id"),
-                "meal_title": title,
-                "seen_on": datetime.utcnow().date().isoformat(),
-            }
+    @staticmethod
+    def meal_history_rows(user_id: Any, meals: List[str]) -> List[Dict[str, Any]]:
+        seen_on = datetime.utcnow().date().isoformat()
+        return [
+            {"user_id": user_id, "meal_title": title, "seen_on": seen_on}
             for title in meals
             if title
         ]
-        if rows:
-            self.client.table("meal_history").insert(rows).execute()
+
+    def insert_meal_history(self, rows: List[Dict[str, Any]]) -> None:
+        """Write meal_history rows for any number of users in as few INSERTs as possible."""
+        for start in range(0, len(rows), MEAL_HISTORY_BATCH_SIZE):
+            _execute(
+                self.client.table("meal_history").insert(
+                    rows[start : start + MEAL_HISTORY_BATCH_SIZE], returning=ReturnMethod.minimal
+                )
+            )
+
+    def save_plan_batch(self, plan_date: str, batch_id: str) -> None:
+        _execute(
+            self.client.table("plan_batches").upsert(
+                {"plan_date": plan_date, "batch_id": batch_id},
+                on_conflict="plan_date",
+                returning=ReturnMethod.minimal,
+            )
+        )
+
+    def get_plan_batch(self, plan_date: str) -> Optional[str]:
+        response = _execute(
+            self.client.table("plan_batches").select("batch_id").eq("plan_date", plan_date).limit(1)
+        )
+        return response.data[0]["batch_id"] if response.data else None
+
+    def delete_plan_batch(self, plan_date: str) -> None:
+        _execute(
+            self.client.table("plan_batches")
+            .delete(returning=ReturnMethod.minimal)
+            .eq("plan_date", plan_date)
+        )
 
     # ------------------------------------------------------------------
     # Subscription helpers
     # ------------------------------------------------------------------
     def has_active_subscription(self, telegram_id: int) -> bool:
-        user = self.get_user(telegram_id)
-        if not user:
-            return False
-
-        response = (
-            self.client.table("subscriptions")
-            .select("status")
-            .eq("user_id", user.get("id"))
-            .eq("status", "active")
-            .limit(1)
-            .execute()
+        response = _execute(
+            self.client.rpc("has_active_subscription", {"user_telegram_id": telegram_id})
         )
         return bool(response.data)
 
@@ -172,12 +352,47 @@ class SupabaseDB:
             "status": status,
             "updated_at": datetime.utcnow().isoformat(),
         }
-        self.client.table("subscriptions").upsert(payload, on_conflict="stripe_subscription_id").execute()
+        _execute(
+            self.client.table("subscriptions").upsert(
+                payload, on_conflict="stripe_subscription_id", returning=ReturnMethod.minimal
+            )
+        )
 
-    def update_subscription_status(self, subscription_id: str, status: str) -> None:
-        self.client.table("subscriptions").update(
-            {"status": status, "updated_at": datetime.utcnow().isoformat()}
-        ).eq("stripe_subscription_id", subscription_id).execute()
+    def update_subscription_status(
+        self, subscription_id: str, status: str, current_period_end: Optional[str] = None
+    ) -> None:
+        fields: Dict[str, Any] = {"status": status, "updated_at": datetime.utcnow().isoformat()}
+        if current_period_end:
+            fields["current_period_end"] = current_period_end
+        query = (
+            self.client.table("subscriptions")
+            .update(fields, returning=ReturnMethod.minimal)
+            .eq("stripe_subscription_id", subscription_id)
+        )
+        if not current_period_end:
+            # Stripe resends unchanged statuses; skip the row lock and WAL for those.
+            # Renewals keep the status but move the period end, so they always write.
+            query = query.neq("status", status)
+        _execute(query)
+
+    def claim_stripe_event(self, event_id: str, event_type: str) -> bool:
+        """Record a Stripe event id; False if it was already claimed (a redelivery)."""
+        response = _execute(
+            self.client.table("processed_stripe_events").upsert(
+                {"event_id": event_id, "event_type": event_type},
+                on_conflict="event_id",
+                ignore_duplicates=True,
+            )
+        )
+        return bool(response.data)
+
+    def release_stripe_event(self, event_id: str) -> None:
+        """Undo a claim so Stripe's next redelivery is processed again."""
+        _execute(
+            self.client.table("processed_stripe_events")
+            .delete(returning=ReturnMethod.minimal)
+            .eq("event_id", event_id)
+        )
 
     # ------------------------------------------------------------------
     # Conversation helpers (legacy compatibility)
@@ -187,38 +402,25 @@ class SupabaseDB:
         if not user:
             return None
 
-        response = (
+        response = _execute(
             self.client.table("conversation_history")
             .select("*")
             .eq("user_id", user.get("id"))
             .order("updated_at", desc=True)
             .limit(1)
             .maybe_single()
-            .execute()
         )
         return response.data if getattr(response, "data", None) else None
 
-    def save_conversation_message(self, telegram_id: int, role: str, content: str) -> None:
-        user = self.get_user(telegram_id)
-        if not user:
-            return
-
-        history = self.get_conversation_history(telegram_id)
-        now = datetime.utcnow().isoformat()
-        if history:
-            messages = history.get("messages", [])
-            messages.append({"role": role, "content": content, "timestamp": now})
-            self.client.table("conversation_history").update(
-                {"messages": messages[-20:], "updated_at": now}
-            ).eq("id", history["id"]).execute()
-        else:
-            self.client.table("conversation_history").insert(
-                {
-                    "user_id": user.get("id"),
-                    "messages": [{"role": role, "content": content, "timestamp": now}],
-                    "updated_at": now,
-                }
-            ).execute()
+    def save_conversation_message(self, telegram_id: int, role: str, content: str) -> bool:
+        # Append and trim to the last 20 messages inside Postgres in one round-trip.
+        response = _execute(
+            self.client.rpc(
+                "append_conversation_message",
+                {"p_telegram_id": telegram_id, "p_role": role, "p_content": content},
+            )
+        )
+        return bool(response.data)
 
 
 Database = SupabaseDB
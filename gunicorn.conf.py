@@ -0,0 +1,11 @@
+def post_worker_init(worker):
+    # Bootstrap after the fork so the bot loop thread lives in the worker process,
+    # and before the worker accepts its first request.
+    from app import bootstrap
+
+    try:
+        bootstrap()
+    except Exception:
+        # Raising here fails the worker boot and halts the whole arbiter. Serve anyway;
+        # the webhooks blueprint's before_request retries the bootstrap.
+        worker.log.exception("Bot bootstrap failed; retrying on the next Telegram webhook")
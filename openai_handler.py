@@ -1,23 +1,192 @@
-import json
+import asyncio
 import logging
-from typing import Any, Dict, List, Optional
+import random
+import threading
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from openai import OpenAI
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TTLCache
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 
-from config import OPENAI_API_KEY, OPENAI_MODEL
+from config import get_settings
 from database import SupabaseDB
 
+settings = get_settings()
 _logger = logging.getLogger(__name__)
 
+# Transient failures on the async path are retried here (429s honour retry-after),
+# not by the SDK, so every attempt passes through the rate limiters again.
+RETRY_ATTEMPTS = 5
+_TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+# Completions allowed in flight at once on the bot loop; extra callers wait their turn.
+MAX_CONCURRENT_COMPLETIONS = 16
+
+_COACH_SYSTEM_PROMPT = "You are a concise nutrition coach. Answer in <= 60 words."
+_PLAN_SCHEMA = (
+    "Keys: meals(list), total_calories(int), tip(string). "
+    "Each meal item: meal('Breakfast'/'Lunch'/'Dinner' or 'Snack'), title, description, calories(int). "
+    "Keep descriptions under 20 words."
+)
+_PLAN_INSTRUCTIONS = (
+    "You are a concise nutrition coach. Return ONLY valid JSON, no markdown. " + _PLAN_SCHEMA
+)
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    if isinstance(exc, RateLimitError):
+        retry_after = exc.response.headers.get("retry-after")
+        if retry_after:
+            return float(retry_after)
+    # Exponential backoff with jitter: ~1s, 2s, 4s ... capped at 30s.
+    return min(2.0 ** (attempt - 1), 30.0) + random.uniform(0, 1)
+
+
+def _dumps(value: Any) -> str:
+    # default=str keeps dates and other non-JSON column types from failing the prompt.
+    return orjson.dumps(value, default=str).decode("utf-8")
+
+
+def _strip_fences(raw: str) -> str:
+    """Drop a ```json ... ``` wrapper the model sometimes adds despite instructions."""
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.removeprefix("```json").removeprefix("```").removesuffix("```")
+    return text.strip()
+
+
+def _normalize_question(text: str) -> str:
+    return " ".join(text.lower().split()).rstrip("?!. ")
+
+
+def _bucket(value: Any, step: int) -> Optional[int]:
+    try:
+        return int(round(float(value) / step) * step)
+    except (TypeError, ValueError):
+        return None
+
+
+def _plan_cache_key(model: str, profile: Dict[str, Any], day_label: str) -> Tuple[Any, ...]:
+    """Coarse profile fingerprint so similar users share one generated plan per day."""
+    return (
+        model,
+        date.today().isoformat(),
+        day_label,
+        profile.get("gender"),
+        profile.get("activity"),
+        profile.get("diet"),
+        _bucket(profile.get("age"), 10),
+        _bucket(profile.get("height_cm"), 5),
+        _bucket(profile.get("weight_kg"), 5),
+        _bucket(profile.get("goal_kg"), 5),
+    )
+
+
+def _repeats_avoided(plan: Dict[str, Any], avoid_titles: Optional[List[str]]) -> bool:
+    if not avoid_titles:
+        return False
+    avoided = {str(title).casefold() for title in avoid_titles}
+    return any(str(meal.get("title", "")).casefold() in avoided for meal in plan.get("meals", ()))
+
+
+def _fallback_plan() -> Dict[str, Any]:
+    """Static plan used whenever the model's answer is missing or unparsable."""
+    return {
+        "meals": [
+            {
+                "meal": "Breakfast",
+                "title": "Oatmeal with Berries",
+                "description": "Rolled oats with almond milk, berries, and seeds.",
+                "calories": 380,
+            },
+            {
+                "meal": "Lunch",
+                "title": "Grilled Chicken Salad",
+                "description": "Chicken, leafy greens, quinoa, vinaigrette.",
+                "calories": 520,
+            },
+            {
+                "meal": "Dinner",
+                "title": "Salmon and Veggies",
+                "description": "Baked salmon with roasted vegetables and brown rice.",
+                "calories": 610,
+            },
+        ],
+        "total_calories": 1510,
+        "tip": "Remember to sip water throughout the day.",
+    }
+
 
 class OpenAIHandler:
     def __init__(self, db: SupabaseDB):
-        if not OPENAI_API_KEY:
+        if not settings.openai_api_key:
             raise ValueError("OPENAI_API_KEY must be configured.")
 
         self.db = db
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
-        self.model = OPENAI_MODEL or "gpt-4o-mini"
+        # One pooled client so repeated completions reuse TCP/TLS connections.
+        self._http = httpx.Client(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+        # Off the scheduler's hot path, so the SDK's own retries/backoff are enough here.
+        self.client = OpenAI(api_key=settings.openai_api_key, http_client=self._http)
+        # Used from the bot loop so the daily job can fan plan generation out concurrently;
+        # HTTP/2 multiplexes those requests over a few TLS connections.
+        self._ahttp = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        )
+        self.aclient = AsyncOpenAI(
+            api_key=settings.openai_api_key, http_client=self._ahttp, max_retries=0
+        )
+        # Keep fan-out under the account's per-minute request and token budgets.
+        self._rpm_limiter = AsyncLimiter(settings.openai_rpm, 60)
+        self._tpm_limiter = AsyncLimiter(settings.openai_tpm, 60)
+        # Counter behind a Condition rather than a Semaphore so the cap can be resized live.
+        self._completion_cond = asyncio.Condition()
+        self._completions_active = 0
+        self.max_concurrent_completions = MAX_CONCURRENT_COMPLETIONS
+        self.model = settings.openai_model or "gpt-4o-mini"
+        # Identical coach questions are answered from memory for 10 minutes.
+        self._answer_cache: TTLCache = TTLCache(maxsize=4096, ttl=600)
+        self._answer_cache_lock = threading.Lock()
+        # Generated plans by coarse profile; the date in the key rotates them daily and
+        # the TTL drops the previous day's entries.
+        self._plan_cache: TTLCache = TTLCache(maxsize=4096, ttl=12 * 3600)
+        self._plan_cache_lock = threading.Lock()
+        # Recipes by (meal title, diet); popular meals are requested by many users.
+        self._recipe_cache: LRUCache = LRUCache(maxsize=1024)
+        self._recipe_cache_lock = threading.Lock()
+
+    def close(self) -> None:
+        self._http.close()
+
+    async def aclose(self) -> None:
+        """Close the async pool; must run on the loop that used it."""
+        await self._ahttp.aclose()
+
+    @asynccontextmanager
+    async def _completion_slot(self) -> AsyncIterator[None]:
+        async with self._completion_cond:
+            await self._completion_cond.wait_for(
+                lambda: self._completions_active < self.max_concurrent_completions
+            )
+            self._completions_active += 1
+        try:
+            yield
+        finally:
+            async with self._completion_cond:
+                self._completions_active -= 1
+                self._completion_cond.notify(1)
 
     def _call_chat_completion(
         self,
@@ -34,19 +203,44 @@ class OpenAIHandler:
         )
         return response.choices[0].message.content.strip()
 
-    def generate_plan_json(
+    async def _acall_chat_completion(
         self,
-        profile: Dict[str, Any],
-        day_label: str,
-        avoid_titles: Optional[List[str]] = None,
-    ) -> Dict[str, Any]:
+        messages: List[Dict[str, str]],
+        *,
+        max_tokens: int = 600,
+        temperature: float = 0.6,
+    ) -> str:
+        # Rough count (~4 chars per token) of prompt plus the completion budget.
+        tokens = sum(len(message["content"]) for message in messages) // 4 + max_tokens
+        attempt = 1
+        while True:
+            await self._rpm_limiter.acquire()
+            await self._tpm_limiter.acquire(min(tokens, settings.openai_tpm))
+            try:
+                async with self._completion_slot():
+                    response = await self.aclient.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                    )
+                return response.choices[0].message.content.strip()
+            except _TRANSIENT_ERRORS as exc:
+                if attempt == RETRY_ATTEMPTS:
+                    raise
+                delay = _retry_delay(exc, attempt)
+                _logger.warning(
+                    "OpenAI call failed (%s); retrying in %.1fs", type(exc).__name__, delay
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    @staticmethod
+    def _plan_prompt(
+        profile: Dict[str, Any], day_label: str, avoid_titles: Optional[List[str]]
+    ) -> str:
         avoid_titles = avoid_titles or []
-        prompt = (
-            "You are a concise nutrition coach. Return ONLY valid JSON, no markdown. "
-            "Keys: meals(list), total_calories(int), tip(string). "
-            "Each meal item: meal('Breakfast'/'Lunch'/'Dinner' or 'Snack'), title, description, calories(int). "
-            "Keep descriptions under 20 words."
-        )
+        prompt = _PLAN_INSTRUCTIONS
 
         extras: List[str] = []
         if day_label:
@@ -55,53 +249,188 @@ class OpenAIHandler:
             extras.append(f"Avoid repeating meals titled: {', '.join(avoid_titles)}.")
 
         prompt += " " + " ".join(extras)
-        prompt += f" PROFILE: {json.dumps(profile)}"
+        prompt += f" PROFILE: {_dumps(profile)}"
+        return prompt
+
+    def plan_cache_key(self, profile: Dict[str, Any], day_label: str) -> Tuple[Any, ...]:
+        return _plan_cache_key(self.model, profile, day_label)
+
+    def cached_plan(
+        self, profile: Dict[str, Any], day_label: str, avoid_titles: Optional[List[str]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Today's plan for a similar profile, unless it repeats one of avoid_titles."""
+        with self._plan_cache_lock:
+            plan = self._plan_cache.get(self.plan_cache_key(profile, day_label))
+        if plan is None or _repeats_avoided(plan, avoid_titles):
+            return None
+        return plan
+
+    def store_plan(self, profile: Dict[str, Any], day_label: str, plan: Dict[str, Any]) -> None:
+        with self._plan_cache_lock:
+            self._plan_cache[self.plan_cache_key(profile, day_label)] = plan
+
+    @staticmethod
+    def _parse_plan(raw: str) -> Optional[Dict[str, Any]]:
+        data = orjson.loads(_strip_fences(raw))
+        return data if "meals" in data else None
+
+    def generate_plan_json(
+        self,
+        profile: Dict[str, Any],
+        day_label: str,
+        avoid_titles: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        cached = self.cached_plan(profile, day_label, avoid_titles)
+        if cached is not None:
+            return cached
 
         try:
             raw = self._call_chat_completion(
-                [{"role": "user", "content": prompt}],
+                [{"role": "user", "content": self._plan_prompt(profile, day_label, avoid_titles)}],
                 max_tokens=700,
                 temperature=0.6,
             )
-            cleaned = raw.strip().strip("`")
-            data = json.loads(cleaned)
-            if "meals" in data:
-                return data
+            plan = self._parse_plan(raw)
+            if plan:
+                self.store_plan(profile, day_label, plan)
+                return plan
         except Exception as exc:
             _logger.exception("OpenAI meal plan generation failed: %s", exc)
 
-        return {
-            "meals": [
-                {
-                    "meal": "Breakfast",
-                    "title": "Oatmeal with Berries",
-                    "description": "Rolled oats with almond milk, berries, and seeds.",
-                    "calories": 380,
-                },
-                {
-                    "meal": "Lunch",
-                    "title": "Grilled Chicken Salad",
-                    "description": "Chicken, leafy greens, quinoa, vinaigrette.",
-                    "calories": 520,
-                },
+        return _fallback_plan()
+
+    async def agenerate_plan_json(
+        self,
+        profile: Dict[str, Any],
+        day_label: str,
+        avoid_titles: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """Async twin of generate_plan_json for callers running on the bot loop."""
+        cached = self.cached_plan(profile, day_label, avoid_titles)
+        if cached is not None:
+            return cached
+
+        try:
+            raw = await self._acall_chat_completion(
+                [{"role": "user", "content": self._plan_prompt(profile, day_label, avoid_titles)}],
+                max_tokens=700,
+                temperature=0.6,
+            )
+            plan = self._parse_plan(raw)
+            if plan:
+                self.store_plan(profile, day_label, plan)
+                return plan
+        except Exception as exc:
+            _logger.exception("OpenAI meal plan generation failed: %s", exc)
+
+        return _fallback_plan()
+
+    async def agenerate_plans_bulk(
+        self, requests: List[Tuple[int, Dict[str, Any], List[str]]], day_label: str
+    ) -> Dict[int, Dict[str, Any]]:
+        """Generate several users' plans in one completion, keyed by telegram_id.
+
+        The instructions are sent once per request instead of once per user. Users
+        missing from the answer are simply absent from the result.
+        """
+        profiles = [
+            {"telegram_id": telegram_id, "avoid_titles": avoid_titles, "profile": profile}
+            for telegram_id, profile, avoid_titles in requests
+        ]
+        prompt = (
+            "You are a concise nutrition coach. Return ONLY valid JSON, no markdown: "
+            "one object mapping each telegram_id (as a string) to that person's plan. "
+            f"Each plan: {_PLAN_SCHEMA} "
+            f"Plans are for {day_label}. Do not repeat a person's avoid_titles. "
+            f"PROFILES: {_dumps(profiles)}"
+        )
+        raw = await self._acall_chat_completion(
+            [{"role": "user", "content": prompt}],
+            max_tokens=700 * len(requests),
+            temperature=0.6,
+        )
+        data = orjson.loads(_strip_fences(raw))
+        plans: Dict[int, Dict[str, Any]] = {}
+        for telegram_id, _, _ in requests:
+            plan = data.get(str(telegram_id))
+            if isinstance(plan, dict) and "meals" in plan:
+                plans[telegram_id] = plan
+        return plans
+
+    # --- Batch API (nightly plan pre-generation at half the token price) ---
+    def submit_plan_batch(
+        self, requests: List[Tuple[int, Dict[str, Any], List[str]]], day_label: str
+    ) -> str:
+        """Queue one plan per (telegram_id, profile, avoid_titles); returns the batch id."""
+        lines = [
+            _dumps(
                 {
-                    "meal": "Dinner",
-                    "title": "Salmon and Veggies",
-                    "description": "Baked salmon with roasted vegetables and brown rice.",
-                    "calories": 610,
-                },
-            ],
-            "total_calories": 1510,
-            "tip": "Remember to sip water throughout the day.",
-        }
+                    "custom_id": str(telegram_id),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": [
+                            {
+                                "role": "user",
+                                "content": self._plan_prompt(profile, day_label, avoid_titles),
+                            }
+                        ],
+                        "max_tokens": 700,
+                        "temperature": 0.6,
+                    },
+                }
+            )
+            for telegram_id, profile, avoid_titles in requests
+        ]
+        batch_file = self.client.files.create(
+            file=("plans.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def collect_plan_batch(self, batch_id: str) -> Optional[Dict[int, Dict[str, Any]]]:
+        """Return plans keyed by telegram_id, or None while the batch is unfinished."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != "completed" or not batch.output_file_id:
+            return None
+
+        plans: Dict[int, Dict[str, Any]] = {}
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                result = orjson.loads(line)
+                body = result["response"]["body"]
+                plan = self._parse_plan(body["choices"][0]["message"]["content"])
+            except Exception as exc:
+                _logger.warning("Skipping unusable batch plan line: %s", exc)
+                continue
+            if plan:
+                plans[int(result["custom_id"])] = plan
+        return plans
+
+    def cancel_plan_batch(self, batch_id: str) -> None:
+        """Stop a batch we no longer need so its unfinished requests are not billed."""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing"):
+            self.client.batches.cancel(batch_id)
 
     def generate_recipe_text(self, meal_title: str, profile: Optional[Dict[str, Any]]) -> str:
-        context = ""
-        if profile:
-            context = json.dumps(profile)
+        # Only the diet shapes the prompt, so the recipe is shared by every user on it.
+        diet = (profile or {}).get("diet") or ""
+        cache_key = (meal_title.strip().casefold(), str(diet).casefold())
+        with self._recipe_cache_lock:
+            cached = self._recipe_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
         try:
-            return self._call_chat_completion(
+            recipe = self._call_chat_completion(
                 [
                     {
                         "role": "user",
@@ -109,7 +438,7 @@ class OpenAIHandler:
                             "Write a short healthy recipe with EXACTLY these sections and labels:\n"
                             "Ingredients:\nSteps:\nTip:\n"
                             "Under 120 words total."
-                            f" Profile: {context}. Meal: {meal_title}"
+                            f" Diet: {diet or 'any'}. Meal: {meal_title}"
                         ),
                     }
                 ],
@@ -120,15 +449,22 @@ class OpenAIHandler:
             _logger.exception("OpenAI recipe generation failed: %s", exc)
             return "Try a balanced plate with lean protein, vegetables, and whole grains."
 
+        with self._recipe_cache_lock:
+            self._recipe_cache[cache_key] = recipe
+        return recipe
+
     def get_ai_response(self, telegram_id: int, user_message: str) -> str:
         _ = self.db.get_user(telegram_id)
+        cache_key = (self.model, _normalize_question(user_message))
+        with self._answer_cache_lock:
+            cached = self._answer_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
-            return self._call_chat_completion(
+            answer = self._call_chat_completion(
                 [
-                    {
-                        "role": "system",
-                        "content": "You are a concise nutrition coach. Answer in <= 60 words.",
-                    },
+                    {"role": "system", "content": _COACH_SYSTEM_PROMPT},
                     {"role": "user", "content": user_message},
                 ],
                 max_tokens=160,
@@ -138,5 +474,9 @@ class OpenAIHandler:
             _logger.exception("OpenAI chat response failed: %s", exc)
             return "I'm having trouble right now—please try again later."
 
+        with self._answer_cache_lock:
+            self._answer_cache[cache_key] = answer
+        return answer
+
 
 __all__ = ["OpenAIHandler"]
@@ -1,10 +1,12 @@
 import asyncio
 import logging
-from datetime import date
-from typing import List
+from datetime import date, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from aiolimiter import AsyncLimiter
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from telegram.error import RetryAfter
 
 from database import SupabaseDB
 from openai_handler import OpenAIHandler
@@ -12,62 +14,313 @@ from telegram_bot import TelegramBot
 
 _logger = logging.getLogger(__name__)
 
+# Telegram allows ~30 messages/second per bot; stay a little below it.
+SEND_RATE_PER_SECOND = 25
+MAX_MESSAGE_LENGTH = 4096
+SEND_ATTEMPTS = 3
+# Concurrent Supabase/OpenAI calls in the plan jobs.
+PLAN_CONCURRENCY = 20
+# Similar users packed into one completion when generating plans live.
+PLAN_BULK_SIZE = 10
+
+# (telegram_id, profile, recent meal titles to avoid)
+PlanRequest = Tuple[int, Dict[str, Any], List[str]]
+
+
+def _meal_lines(meal: Dict[str, Any]) -> Iterator[str]:
+    get = meal.get
+    yield ""
+    yield f"{get('meal', 'Meal')}: {get('title', '')}"
+    desc = get("description")
+    if desc:
+        yield desc
+    calories = get("calories")
+    if calories:
+        yield f"Calories: {calories}"
+
+
+def _plan_lines(user: Dict[str, Any], plan: Dict[str, Any]) -> Iterator[str]:
+    yield "🥗 BiteIQ Daily Plan"
+    name = user.get("name")
+    if name:
+        yield f"Hi {name}!"
+    for meal in plan.get("meals", ()):
+        yield from _meal_lines(meal)
+    total_calories = plan.get("total_calories")
+    if total_calories:
+        yield ""
+        yield f"Total: {total_calories} kcal"
+    tip = plan.get("tip")
+    if tip:
+        yield f"Tip: {tip}"
+
 
 class Scheduler:
-    def __init__(self, db: SupabaseDB, openai_handler: OpenAIHandler, telegram_bot: TelegramBot):
+    def __init__(
+        self,
+        db: SupabaseDB,
+        openai_handler: OpenAIHandler,
+        telegram_bot: TelegramBot,
+        event_loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
         self.db = db
         self.openai_handler = openai_handler
         self.telegram_bot = telegram_bot
-        self._scheduler = BackgroundScheduler()
+        # Jobs run on the bot's loop so sends share the Application's HTTP pool.
+        self._scheduler = AsyncIOScheduler(event_loop=event_loop)
         self._started = False
+        # (plan date, plans) downloaded by the pre-send poll; the batch id itself is kept
+        # in Supabase so a restart overnight can still collect or cancel it.
+        self._batch_plans: Optional[Tuple[date, Dict[int, Dict[str, Any]]]] = None
 
     def _format_plan_message(self, user: dict, plan: dict) -> str:
-        lines: List[str] = ["🥗 BiteIQ Daily Plan"]
-        if user.get("name"):
-            lines.append(f"Hi {user['name']}!")
-        for meal in plan.get("meals", []):
-            lines.append("")
-            lines.append(f"{meal.get('meal', 'Meal')}: {meal.get('title', '')}")
-            desc = meal.get("description")
-            if desc:
-                lines.append(desc)
-            calories = meal.get("calories")
-            if calories:
-                lines.append(f"Calories: {calories}")
-        if plan.get("total_calories"):
-            lines.append("")
-            lines.append(f"Total: {plan['total_calories']} kcal")
-        if plan.get("tip"):
-            lines.append(f"Tip: {plan['tip']}")
-        return "\n".join(lines)
-
-    def _send_daily_plan(self):
-        _logger.info("Running daily meal plan job")
-        users = self.db.get_all_users()
-        for user in users:
-            telegram_id = user.get("telegram_id")
-            if not telegram_id:
-                continue
-            if not self.db.has_active_subscription(telegram_id):
+        return "\n".join(_plan_lines(user, plan))
+
+    def _group_messages(self, messages: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+        """Merge messages for the same chat, keeping each under Telegram's size limit."""
+        grouped: Dict[int, List[str]] = {}
+        for chat_id, text in messages:
+            chunks = grouped.setdefault(chat_id, [])
+            if chunks and len(chunks[-1]) + 2 + len(text) <= MAX_MESSAGE_LENGTH:
+                chunks[-1] = f"{chunks[-1]}\n\n{text}"
+            else:
+                chunks.append(text)
+        return [(chat_id, text) for chat_id, chunks in grouped.items() for text in chunks]
+
+    async def _send_message(self, limiter: AsyncLimiter, chat_id: int, text: str) -> None:
+        bot = self.telegram_bot.application.bot
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            async with limiter:
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text)
+                    return
+                except RetryAfter as exc:
+                    if attempt == SEND_ATTEMPTS:
+                        raise
+                    retry_after = exc.retry_after
+            # Flood control: wait as told, outside the limiter so other chats keep flowing.
+            await asyncio.sleep(float(retry_after))
+
+    async def _send_messages(self, messages: List[Tuple[int, str]]) -> None:
+        limiter = AsyncLimiter(SEND_RATE_PER_SECOND, 1)
+        grouped = self._group_messages(messages)
+        results = await asyncio.gather(
+            *(self._send_message(limiter, chat_id, text) for chat_id, text in grouped),
+            return_exceptions=True,
+        )
+        for (chat_id, _), result in zip(grouped, results):
+            if isinstance(result, BaseException):
+                _logger.error(
+                    "Failed to send daily plan to %s: %s", chat_id, result, exc_info=result
+                )
+
+    async def _plan_requests(
+        self, users: List[dict], semaphore: asyncio.Semaphore
+    ) -> List[PlanRequest]:
+        """Attach each user's recent meal titles so the model avoids repeats."""
+
+        async def _with_recent(user: dict) -> PlanRequest:
+            telegram_id = user["telegram_id"]
+            try:
+                async with semaphore:
+                    recent_meals = await asyncio.to_thread(self.db.get_recent_meals, telegram_id)
+            except Exception as exc:
+                # A missing history only risks a repeated meal; still send the plan.
+                _logger.warning("Recent meals lookup failed for %s: %s", telegram_id, exc)
+                recent_meals = []
+            return telegram_id, user, recent_meals
+
+        return list(await asyncio.gather(*(_with_recent(user) for user in users)))
+
+    @staticmethod
+    def _plan_group_key(user: dict) -> Tuple[Any, Any, str]:
+        weight, goal = user.get("weight_kg"), user.get("goal_kg")
+        direction = "maintain"
+        if weight and goal:
+            direction = "lose" if goal < weight else "gain" if goal > weight else "maintain"
+        return user.get("diet"), user.get("activity"), direction
+
+    async def _generate_live_plans(
+        self, requests: List[PlanRequest], semaphore: asyncio.Semaphore
+    ) -> Dict[int, Dict[str, Any]]:
+        """Serve cached plans, generate one per similar profile in bulk, then fill gaps singly."""
+        handler = self.openai_handler
+        plans: Dict[int, Dict[str, Any]] = {}
+        # One request per plan cache key is generated; users sharing the key reuse its plan.
+        leaders: Dict[Tuple[Any, ...], PlanRequest] = {}
+        followers: List[PlanRequest] = []
+        for request in requests:
+            telegram_id, user, recent_meals = request
+            cached = handler.cached_plan(user, "today", recent_meals)
+            if cached is not None:
+                plans[telegram_id] = cached
                 continue
+            cache_key = handler.plan_cache_key(user, "today")
+            if cache_key in leaders:
+                followers.append(request)
+            else:
+                leaders[cache_key] = request
+
+        groups: Dict[Tuple[Any, Any, str], List[PlanRequest]] = {}
+        for request in leaders.values():
+            groups.setdefault(self._plan_group_key(request[1]), []).append(request)
+        chunks = [
+            group[start : start + PLAN_BULK_SIZE]
+            for group in groups.values()
+            for start in range(0, len(group), PLAN_BULK_SIZE)
+        ]
+
+        async def _bulk(chunk: List[PlanRequest]) -> Dict[int, Dict[str, Any]]:
+            async with semaphore:
+                return await handler.agenerate_plans_bulk(chunk, "today")
+
+        results = await asyncio.gather(*(_bulk(chunk) for chunk in chunks), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                _logger.warning("Bulk plan generation failed; retrying users singly: %s", result)
+            else:
+                plans.update(result)
+        for telegram_id, user, _ in leaders.values():
+            if telegram_id in plans:
+                handler.store_plan(user, "today", plans[telegram_id])
+
+        for telegram_id, user, recent_meals in followers:
+            cached = handler.cached_plan(user, "today", recent_meals)
+            if cached is not None:
+                plans[telegram_id] = cached
+
+        async def _single(request: PlanRequest) -> Tuple[int, Dict[str, Any]]:
+            telegram_id, user, recent_meals = request
+            async with semaphore:
+                return telegram_id, await handler.agenerate_plan_json(user, "today", recent_meals)
+
+        missing = [request for request in requests if request[0] not in plans]
+        plans.update(await asyncio.gather(*(_single(request) for request in missing)))
+        return plans
+
+    async def _submit_plan_batch(self) -> None:
+        """Evening job: queue tomorrow's plans on the Batch API."""
+        subscribed = await asyncio.to_thread(self.db.get_subscribed_users)
+        semaphore = asyncio.Semaphore(PLAN_CONCURRENCY)
+        requests = await self._plan_requests(subscribed, semaphore)
+        if not requests:
+            return
+
+        plan_date = (date.today() + timedelta(days=1)).isoformat()
+        batch_id = await asyncio.to_thread(self.openai_handler.submit_plan_batch, requests, "today")
+        try:
+            await asyncio.to_thread(self.db.save_plan_batch, plan_date, batch_id)
+        except Exception:
+            # Nobody could collect it in the morning; don't pay for it.
+            await asyncio.to_thread(self.openai_handler.cancel_plan_batch, batch_id)
+            raise
+        _logger.info("Submitted plan batch %s for %d users", batch_id, len(requests))
+
+    async def _download_plan_batch(self, batch_id: str) -> Optional[Dict[int, Dict[str, Any]]]:
+        try:
+            return await asyncio.to_thread(self.openai_handler.collect_plan_batch, batch_id)
+        except Exception as exc:
+            _logger.exception("Failed to collect plan batch %s: %s", batch_id, exc)
+            return None
+
+    async def _poll_plan_batch(self) -> None:
+        """Pre-send job: download the evening batch as soon as it completes."""
+        today = date.today()
+        if self._batch_plans and self._batch_plans[0] == today:
+            return
+        try:
+            batch_id = await asyncio.to_thread(self.db.get_plan_batch, today.isoformat())
+        except Exception as exc:
+            _logger.warning("Plan batch lookup failed: %s", exc)
+            return
+        if not batch_id:
+            return
+        plans = await self._download_plan_batch(batch_id)
+        if plans is not None:
+            self._batch_plans = (today, plans)
+            _logger.info("Collected plan batch %s with %d plans", batch_id, len(plans))
+
+    async def _collect_plan_batch(self) -> Dict[int, Dict[str, Any]]:
+        """Use the evening batch if it finished; otherwise cancel it and go live."""
+        today = date.today()
+        plan_date = today.isoformat()
+        if self._batch_plans and self._batch_plans[0] == today:
+            plans = self._batch_plans[1]
+        else:
             try:
-                recent_meals = self.db.get_recent_meals(telegram_id)
-                plan = self.openai_handler.generate_plan_json(user, "today", recent_meals)
-                self.db.save_plan(telegram_id, date.today().isoformat(), plan)
-                self.db.add_meals_to_history(
-                    telegram_id, [meal.get("title") for meal in plan.get("meals", [])]
+                batch_id = await asyncio.to_thread(self.db.get_plan_batch, plan_date)
+            except Exception as exc:
+                _logger.exception("Plan batch lookup failed: %s", exc)
+                return {}
+            if not batch_id:
+                return {}
+            plans = await self._download_plan_batch(batch_id)
+            if plans is None:
+                _logger.warning(
+                    "Plan batch %s not finished; cancelling it and generating plans live",
+                    batch_id,
                 )
-                message = self._format_plan_message(user, plan)
-                asyncio.run(
-                    self.telegram_bot.application.bot.send_message(
-                        chat_id=telegram_id,
-                        text=message,
-                    )
+                try:
+                    await asyncio.to_thread(self.openai_handler.cancel_plan_batch, batch_id)
+                except Exception as exc:
+                    _logger.exception("Failed to cancel plan batch %s: %s", batch_id, exc)
+                plans = {}
+        self._batch_plans = None
+        try:
+            await asyncio.to_thread(self.db.delete_plan_batch, plan_date)
+        except Exception as exc:
+            _logger.warning("Failed to clear plan batch for %s: %s", plan_date, exc)
+        return plans
+
+    async def _send_daily_plan(self):
+        _logger.info("Running daily meal plan job")
+        # One joined query instead of a subscription lookup per user.
+        subscribed = await asyncio.to_thread(self.db.get_subscribed_users)
+        # Bounds concurrent Supabase/OpenAI calls, keeping the job under the RPM limit.
+        semaphore = asyncio.Semaphore(PLAN_CONCURRENCY)
+
+        plans = await self._collect_plan_batch()
+        pending = [user for user in subscribed if user["telegram_id"] not in plans]
+        if pending:
+            requests = await self._plan_requests(pending, semaphore)
+            plans.update(await self._generate_live_plans(requests, semaphore))
+
+        plan_date = date.today().isoformat()
+
+        async def _save(telegram_id: int, plan: Dict[str, Any]) -> None:
+            async with semaphore:
+                await asyncio.to_thread(self.db.save_plan, telegram_id, plan_date, plan)
+
+        outbox: List[Tuple[int, str]] = []
+        history_rows: List[Dict[str, Any]] = []
+        saves = []
+        for user in subscribed:
+            plan = plans.get(user["telegram_id"])
+            if not plan:
+                continue
+            saves.append(_save(user["telegram_id"], plan))
+            outbox.append((user["telegram_id"], self._format_plan_message(user, plan)))
+            history_rows.extend(
+                self.db.meal_history_rows(
+                    user.get("id"), [meal.get("title") for meal in plan.get("meals", [])]
                 )
+            )
+
+        for result in await asyncio.gather(*saves, return_exceptions=True):
+            if isinstance(result, BaseException):
+                _logger.error("Failed to save daily plan: %s", result, exc_info=result)
+
+        if history_rows:
+            try:
+                await asyncio.to_thread(self.db.insert_meal_history, history_rows)
             except Exception as exc:
-                _logger.exception("Failed to send daily plan to %s: %s", telegram_id, exc)
+                _logger.exception("Failed to record meal history: %s", exc)
+
+        if outbox:
+            await self._send_messages(outbox)
 
     def start(self) -> None:
+        """Must be called from the event loop the scheduler was created for."""
         if self._started:
             return
         self._scheduler.add_job(
@@ -76,6 +329,19 @@ class Scheduler:
             id="daily-plan",
             replace_existing=True,
         )
+        self._scheduler.add_job(
+            self._submit_plan_batch,
+            CronTrigger(hour=22, minute=0),
+            id="plan-batch",
+            replace_existing=True,
+        )
+        # Poll the batch during the hour before the send instead of only at 06:00.
+        self._scheduler.add_job(
+            self._poll_plan_batch,
+            CronTrigger(hour=5, minute="*/10"),
+            id="plan-batch-poll",
+            replace_existing=True,
+        )
         self._scheduler.start()
         self._started = True
         _logger.info("Scheduler started")
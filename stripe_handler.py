@@ -1,64 +1,111 @@
-from typing import Any, Dict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
 
-from flask import jsonify
+import requests
 import stripe
+from requests.adapters import HTTPAdapter
 
-from config import STRIPE_PRICE_ID, STRIPE_SECRET_KEY, STRIPE_WEBHOOK_SECRET, WEBHOOK_URL
+from config import get_settings
 from database import SupabaseDB
 
-stripe.api_key = STRIPE_SECRET_KEY
+settings = get_settings()
+stripe.api_key = settings.stripe_secret_key
+# Stripe's client retries connection errors, 409s and 5xx with idempotency keys, so a
+# blip during checkout creation does not bounce the user.
+stripe.max_network_retries = 3
+
+# One keep-alive pool to api.stripe.com shared by every executor thread, sized so each
+# thread can hold a connection without queueing.
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(pool_maxsize=settings.thread_pool_size))
+stripe.default_http_client = stripe.RequestsClient(session=_stripe_session)
+
+
+# Checkout Session.status is the session's own state ("complete"), not the subscription's;
+# derive the subscription status from how the session was paid.
+_CHECKOUT_SUBSCRIPTION_STATUS = {"paid": "active", "no_payment_required": "trialing"}
+
+
+def _period_end(data_object: Dict[str, Any]) -> Optional[str]:
+    timestamp = data_object.get("current_period_end")
+    if not timestamp:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
 
 
 class StripeHandler:
     def __init__(self, db: SupabaseDB):
-        if not STRIPE_SECRET_KEY:
+        if not settings.stripe_secret_key:
             raise ValueError("STRIPE_SECRET_KEY must be configured.")
-        if not STRIPE_WEBHOOK_SECRET:
+        if not settings.stripe_webhook_secret:
             raise ValueError("STRIPE_WEBHOOK_SECRET must be configured.")
         self.db = db
+        # Doubles as the allowlist of Stripe event types we act on.
+        self._event_handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {
+            "checkout.session.completed": self._on_checkout_completed,
+            "customer.subscription.updated": self._on_subscription_changed,
+            "customer.subscription.deleted": self._on_subscription_changed,
+        }
 
     def create_checkout_session(self, telegram_id: int) -> str:
         session = stripe.checkout.Session.create(
             payment_method_types=["card"],
-            line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
+            line_items=[{"price": settings.stripe_price_id, "quantity": 1}],
             mode="subscription",
-            success_url=f"{WEBHOOK_URL}/payment-success?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{WEBHOOK_URL}/payment-cancelled",
+            success_url=f"{settings.webhook_url}/payment-success?session_id={{CHECKOUT_SESSION_ID}}",
+            cancel_url=f"{settings.webhook_url}/payment-cancelled",
             client_reference_id=str(telegram_id),
-            metadata={"telegram_id": str(telegram_id), "price_id": STRIPE_PRICE_ID},
+            metadata={"telegram_id": str(telegram_id), "price_id": settings.stripe_price_id},
         )
         return session.url
 
-    def handle_webhook_event(self, payload: bytes, signature: str):  # Flask response tuple
-        try:
-            event = stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
-        except Exception as exc:  # pragma: no cover - handled via HTTP status
-            return jsonify({"error": str(exc)}), 400
+    def construct_event(self, payload: bytes, signature: str) -> Dict[str, Any]:
+        """Verify the webhook signature and return the event as a dict (raises on mismatch)."""
+        event = stripe.Webhook.construct_event(payload, signature, settings.stripe_webhook_secret)
+        # Newer stripe releases' StripeObject is no longer a dict subclass; hand the
+        # handlers plain dicts so .get() works regardless of the installed version.
+        return event.to_dict()
 
-        event_type = event.get("type")
-        data_object: Dict[str, Any] = event.get("data", {}).get("object", {})
+    def handles(self, event_type: Optional[str]) -> bool:
+        return event_type in self._event_handlers
 
-        if event_type == "checkout.session.completed":
-            telegram_id = int(
-                data_object.get("client_reference_id")
-                or data_object.get("metadata", {}).get("telegram_id", 0)
+    def handle_webhook_event(self, event: Dict[str, Any]) -> None:
+        handler = self._event_handlers.get(event.get("type"))
+        if not handler:
+            return
+
+        event_id = event.get("id")
+        if event_id and not self.db.claim_stripe_event(event_id, event["type"]):
+            return
+        try:
+            handler(event.get("data", {}).get("object", {}))
+        except Exception:
+            if event_id:
+                self.db.release_stripe_event(event_id)
+            raise
+
+    # --- Event handlers ---
+    def _on_checkout_completed(self, data_object: Dict[str, Any]) -> None:
+        telegram_id = int(
+            data_object.get("client_reference_id")
+            or data_object.get("metadata", {}).get("telegram_id", 0)
+        )
+        customer_id = data_object.get("customer")
+        subscription_id = data_object.get("subscription")
+        price_id = data_object.get("metadata", {}).get("price_id")
+        status = _CHECKOUT_SUBSCRIPTION_STATUS.get(data_object.get("payment_status"), "incomplete")
+        if telegram_id and customer_id and subscription_id:
+            self.db.create_subscription(
+                telegram_id=telegram_id,
+                customer_id=customer_id,
+                sub_id=subscription_id,
+                price_id=price_id or "unknown",
+                status=status,
             )
-            customer_id = data_object.get("customer")
-            subscription_id = data_object.get("subscription")
-            price_id = data_object.get("metadata", {}).get("price_id")
-            status = data_object.get("status", "active")
-            if telegram_id and customer_id and subscription_id:
-                self.db.create_subscription(
-                    telegram_id=telegram_id,
-                    customer_id=customer_id,
-                    sub_id=subscription_id,
-                    price_id=price_id or "unknown",
-                    status=status,
-                )
-        elif event_type in {"customer.subscription.updated", "customer.subscription.deleted"}:
-            subscription_id = data_object.get("id")
-            status = data_object.get("status", "canceled")
-            if subscription_id:
-                self.db.update_subscription_status(subscription_id, status)
-
-        return jsonify({"status": "success"}), 200
+
+    def _on_subscription_changed(self, data_object: Dict[str, Any]) -> None:
+        subscription_id = data_object.get("id")
+        status = data_object.get("status", "canceled")
+        if subscription_id:
+            # The subscription object is inline in the event; no Subscription.retrieve needed.
+            self.db.update_subscription_status(subscription_id, status, _period_end(data_object))
@@ -0,0 +1,58 @@
+/*
+  # Append Conversation Messages Server-Side
+
+  1. New Functions
+    - `append_conversation_message(p_telegram_id, p_role, p_content, p_max_messages)`
+      - Resolves the user by telegram_id
+      - Appends one message to the user's latest conversation_history row,
+        keeping only the last `p_max_messages` entries
+      - Creates the row when the user has no history yet
+      - Replaces the client-side read-modify-write of the whole messages array
+
+  2. Security
+    - SECURITY DEFINER with an explicit search_path, like the other helpers
+*/
+
+CREATE OR REPLACE FUNCTION append_conversation_message(
+  p_telegram_id bigint,
+  p_role text,
+  p_content text,
+  p_max_messages int DEFAULT 20
+)
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_user_id uuid;
+  v_entry jsonb;
+BEGIN
+  SELECT id INTO v_user_id FROM users WHERE telegram_id = p_telegram_id;
+  IF v_user_id IS NULL THEN
+    RETURN;
+  END IF;
+
+  v_entry := jsonb_build_object('role', p_role, 'content', p_content, 'timestamp', now());
+
+  UPDATE conversation_history ch
+  SET messages = (
+        SELECT coalesce(jsonb_agg(t.m ORDER BY t.i), '[]'::jsonb)
+        FROM jsonb_array_elements(coalesce(ch.messages, '[]'::jsonb) || v_entry)
+          WITH ORDINALITY AS t(m, i)
+        WHERE t.i > jsonb_array_length(coalesce(ch.messages, '[]'::jsonb)) + 1 - p_max_messages
+      ),
+      updated_at = now()
+  WHERE ch.id = (
+    SELECT id FROM conversation_history
+    WHERE user_id = v_user_id
+    ORDER BY updated_at DESC
+    LIMIT 1
+  );
+
+  IF NOT FOUND THEN
+    INSERT INTO conversation_history (user_id, messages)
+    VALUES (v_user_id, jsonb_build_array(v_entry));
+  END IF;
+END;
+$$;
@@ -0,0 +1,29 @@
+/*
+  # Make has_active_subscription a STABLE SQL Function
+
+  1. Function Changes
+    - `has_active_subscription(user_telegram_id)` is rewritten as a single
+      `LANGUAGE sql STABLE` query so the planner can inline and cache it
+    - Semantics are unchanged: active or trialing, and not past current_period_end
+    - The bot now calls it through RPC instead of SELECTing from subscriptions
+
+  2. Security
+    - Keeps SECURITY DEFINER and the explicit search_path
+*/
+
+CREATE OR REPLACE FUNCTION has_active_subscription(user_telegram_id bigint)
+RETURNS boolean
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT EXISTS(
+    SELECT 1
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.id
+    WHERE u.telegram_id = user_telegram_id
+      AND s.status IN ('active', 'trialing')
+      AND (s.current_period_end IS NULL OR s.current_period_end > now())
+  );
+$$;
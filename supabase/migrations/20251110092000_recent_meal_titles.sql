@@ -0,0 +1,37 @@
+/*
+  # Recent Meal Titles Lookup
+
+  1. New Functions
+    - `recent_meal_titles(p_telegram_id, p_limit)`
+      - Reads the user's latest `p_limit` meal_history rows through
+        idx_meal_history_user_date
+      - Returns their distinct titles, newest first, as a text[]
+      - Replaces the users lookup, the row fetch and the client-side dedupe
+
+  2. Security
+    - SECURITY DEFINER with an explicit search_path, like the other helpers
+*/
+
+CREATE OR REPLACE FUNCTION recent_meal_titles(p_telegram_id bigint, p_limit int DEFAULT 10)
+RETURNS text[]
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT coalesce(array_agg(meal_title ORDER BY last_seen DESC, last_created DESC), '{}')
+  FROM (
+    SELECT recent.meal_title,
+           max(recent.seen_on) AS last_seen,
+           max(recent.created_at) AS last_created
+    FROM (
+      SELECT mh.meal_title, mh.seen_on, mh.created_at
+      FROM meal_history mh
+      JOIN users u ON u.id = mh.user_id
+      WHERE u.telegram_id = p_telegram_id
+      ORDER BY mh.seen_on DESC, mh.created_at DESC
+      LIMIT p_limit
+    ) recent
+    GROUP BY recent.meal_title
+  ) titles;
+$$;
@@ -0,0 +1,22 @@
+/*
+  # Indexes for Hot Access Paths
+
+  1. New Indexes
+    - `idx_subscriptions_user_live` on subscriptions(user_id) INCLUDE (current_period_end),
+      partial on status IN ('active', 'trialing')
+      - Serves has_active_subscription without touching canceled rows
+    - `idx_conversation_user_updated` on conversation_history(user_id, updated_at DESC)
+      - Serves the "latest history row per user" lookup in append_conversation_message
+
+  2. Already Covered
+    - users(telegram_id) is UNIQUE
+    - plans(user_id, plan_date) is the primary key
+    - meal_history(user_id, seen_on DESC) exists as idx_meal_history_user_date
+*/
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_live
+  ON subscriptions(user_id) INCLUDE (current_period_end)
+  WHERE status IN ('active', 'trialing');
+
+CREATE INDEX IF NOT EXISTS idx_conversation_user_updated
+  ON conversation_history(user_id, updated_at DESC);
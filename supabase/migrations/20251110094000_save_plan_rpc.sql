@@ -0,0 +1,26 @@
+/*
+  # Save Plans by Telegram ID
+
+  1. New Functions
+    - `save_plan(p_telegram_id, p_plan_date, p_plan_json)`
+      - Resolves users.id from telegram_id inside the same statement
+      - Upserts on the (user_id, plan_date) primary key
+      - Saves the bot a users lookup before every plan write
+
+  2. Security
+    - SECURITY DEFINER with an explicit search_path, like the other helpers
+*/
+
+CREATE OR REPLACE FUNCTION save_plan(p_telegram_id bigint, p_plan_date date, p_plan_json jsonb)
+RETURNS void
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  INSERT INTO plans (user_id, plan_date, plan_json)
+  SELECT id, p_plan_date, p_plan_json
+  FROM users
+  WHERE telegram_id = p_telegram_id
+  ON CONFLICT (user_id, plan_date)
+  DO UPDATE SET plan_json = EXCLUDED.plan_json, created_at = now();
+$$;
@@ -0,0 +1,32 @@
+/*
+  # Processed Stripe Events
+
+  1. New Tables
+    - `processed_stripe_events`
+      - `event_id` (text, primary key) - Stripe event id (evt_...)
+      - `event_type` (text) - Stripe event type
+      - `processed_at` (timestamptz) - When the bot claimed the event
+
+  2. Purpose
+    - Stripe delivers webhooks at least once and retries for days; the bot claims
+      each event id here before applying it so a redelivery across restarts or
+      workers is a no-op
+
+  3. Security
+    - Enable RLS
+    - Add policy for service role access
+*/
+
+CREATE TABLE IF NOT EXISTS processed_stripe_events (
+  event_id text PRIMARY KEY,
+  event_type text NOT NULL,
+  processed_at timestamptz DEFAULT now()
+);
+
+ALTER TABLE processed_stripe_events ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage processed stripe events"
+  ON processed_stripe_events FOR ALL
+  TO service_role
+  USING (true)
+  WITH CHECK (true);
@@ -0,0 +1,32 @@
+/*
+  # Plan Batches
+
+  1. New Tables
+    - `plan_batches`
+      - `plan_date` (date, primary key) - Day the batched plans are for
+      - `batch_id` (text) - OpenAI Batch API id (batch_...)
+      - `created_at` (timestamptz) - When the evening job submitted the batch
+
+  2. Purpose
+    - The evening job submits tomorrow's plans to the Batch API; keeping the id
+      here lets the morning job collect (or cancel) it after a restart instead of
+      regenerating everything live while the batch is still billed
+
+  3. Security
+    - Enable RLS
+    - Add policy for service role access
+*/
+
+CREATE TABLE IF NOT EXISTS plan_batches (
+  plan_date date PRIMARY KEY,
+  batch_id text NOT NULL,
+  created_at timestamptz DEFAULT now()
+);
+
+ALTER TABLE plan_batches ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage plan batches"
+  ON plan_batches FOR ALL
+  TO service_role
+  USING (true)
+  WITH CHECK (true);
@@ -0,0 +1,35 @@
+/*
+  # save_plan Returns a Result
+
+  1. Function Changes
+    - `save_plan(p_telegram_id, p_plan_date, p_plan_json)` now RETURNS boolean
+      instead of void: true when a plan row was written, false when no user
+      has that telegram_id
+    - PostgREST answers void RPCs with an empty 204, which the pinned
+      postgrest client fails to parse, so every save raised an APIError
+    - The function is dropped first because CREATE OR REPLACE cannot change
+      a return type
+
+  2. Security
+    - SECURITY DEFINER with an explicit search_path, like the other helpers
+*/
+
+DROP FUNCTION IF EXISTS save_plan(bigint, date, jsonb);
+
+CREATE FUNCTION save_plan(p_telegram_id bigint, p_plan_date date, p_plan_json jsonb)
+RETURNS boolean
+LANGUAGE sql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  WITH saved AS (
+    INSERT INTO plans (user_id, plan_date, plan_json)
+    SELECT id, p_plan_date, p_plan_json
+    FROM users
+    WHERE telegram_id = p_telegram_id
+    ON CONFLICT (user_id, plan_date)
+    DO UPDATE SET plan_json = EXCLUDED.plan_json, created_at = now()
+    RETURNING 1
+  )
+  SELECT EXISTS(SELECT 1 FROM saved);
+$$;
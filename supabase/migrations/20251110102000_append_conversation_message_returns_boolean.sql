@@ -0,0 +1,63 @@
+/*
+  # append_conversation_message Returns a Result
+
+  1. Function Changes
+    - `append_conversation_message(p_telegram_id, p_role, p_content, p_max_messages)`
+      now RETURNS boolean instead of void: true when the message was stored,
+      false when no user has that telegram_id
+    - PostgREST answers void RPCs with an empty 204, which the pinned
+      postgrest client fails to parse, so every append raised an APIError
+    - The function is dropped first because CREATE OR REPLACE cannot change
+      a return type
+
+  2. Security
+    - SECURITY DEFINER with an explicit search_path, like the other helpers
+*/
+
+DROP FUNCTION IF EXISTS append_conversation_message(bigint, text, text, int);
+
+CREATE FUNCTION append_conversation_message(
+  p_telegram_id bigint,
+  p_role text,
+  p_content text,
+  p_max_messages int DEFAULT 20
+)
+RETURNS boolean
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_user_id uuid;
+  v_entry jsonb;
+BEGIN
+  SELECT id INTO v_user_id FROM users WHERE telegram_id = p_telegram_id;
+  IF v_user_id IS NULL THEN
+    RETURN false;
+  END IF;
+
+  v_entry := jsonb_build_object('role', p_role, 'content', p_content, 'timestamp', now());
+
+  UPDATE conversation_history ch
+  SET messages = (
+        SELECT coalesce(jsonb_agg(t.m ORDER BY t.i), '[]'::jsonb)
+        FROM jsonb_array_elements(coalesce(ch.messages, '[]'::jsonb) || v_entry)
+          WITH ORDINALITY AS t(m, i)
+        WHERE t.i > jsonb_array_length(coalesce(ch.messages, '[]'::jsonb)) + 1 - p_max_messages
+      ),
+      updated_at = now()
+  WHERE ch.id = (
+    SELECT id FROM conversation_history
+    WHERE user_id = v_user_id
+    ORDER BY updated_at DESC
+    LIMIT 1
+  );
+
+  IF NOT FOUND THEN
+    INSERT INTO conversation_history (user_id, messages)
+    VALUES (v_user_id, jsonb_build_array(v_entry));
+  END IF;
+
+  RETURN true;
+END;
+$$;
@@ -1,6 +1,6 @@
+import asyncio
 import logging
-import os
-from typing import Any, Dict, List, Optional
+from typing import Any
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
@@ -11,70 +11,161 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
-from config import TELEGRAM_BOT_TOKEN
+from config import get_settings
 from database import SupabaseDB
 from openai_handler import OpenAIHandler
 from stripe_handler import StripeHandler
 
+settings = get_settings()
 _logger = logging.getLogger(__name__)
 
+# Update kinds we register handlers for; anything else is acknowledged and dropped.
+HANDLED_UPDATE_TYPES = frozenset({"message", "callback_query"})
+
+UPDATE_CONCURRENCY = 256
+UPDATE_QUEUE_SIZE = 10_000
+
+# Text-less private message: parses like a real update but matches no handler.
+_WARMUP_UPDATE = {
+    "update_id": 0,
+    "message": {"message_id": 0, "date": 0, "chat": {"id": 0, "type": "private"}},
+}
+
+
+# Static replies, built once at import.
+_WELCOME_TEXT = "👋 Welcome to BiteIQBot! The webhook is working ✅"
+_MENU_TEXT = "📋 Menu options:"
+_MENU_MARKUP = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("ℹ️ Help", callback_data="help")],
+        [InlineKeyboardButton("💳 Subscribe", callback_data="subscribe")],
+    ]
+)
+
+# MarkdownV2 reserved characters, escaped in one str.translate pass.
+_MD_ESCAPES = str.maketrans({char: f"\\{char}" for char in "\\_*[]()~`>#+-=|{}.!"})
+
 
 def _md(text: Any) -> str:
-    risky = ["\\", "_", "*", "[", "]", "(", ")", "~", "`", ">", "#", "+", "-", "=", "|", "{", "}", ".", "!"]
-    safe = escape_markdown(str(text), version=2)
-    for char in risky:
-        safe = safe.replace(char, f"\\{char}")
-    return safe
+    return str(text).translate(_MD_ESCAPES)
 
 
 class TelegramBot:
+    __slots__ = ("db", "openai_handler", "stripe_handler", "application", "bot", "_loop")
+
     def __init__(self, db: SupabaseDB, openai_handler: OpenAIHandler, stripe_handler: StripeHandler):
         self.db = db
         self.openai_handler = openai_handler
         self.stripe_handler = stripe_handler
-        self.application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-        self._register_handlers()
+        # Built in initialize(), so constructing the bot opens no HTTP pools.
+        self.application: Application | None = None
+        self.bot = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _build_application(self) -> Application:
+        # One tuned pool for all outbound Bot API calls; HTTP/2 multiplexes concurrent sends.
+        request = HTTPXRequest(
+            connection_pool_size=200,
+            pool_timeout=10.0,
+            connect_timeout=3.0,
+            read_timeout=10.0,
+            http_version="2",
+        )
+        return (
+            Application.builder()
+            .token(settings.telegram_bot_token)
+            .request(request)
+            # Webhook-only: PTB's own fetcher drains update_queue and runs handlers concurrently.
+            .updater(None)
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            .concurrent_updates(UPDATE_CONCURRENCY)
+            .build()
+        )
 
     async def initialize(self):
         """Initialize Telegram bot and set webhook URL."""
-        base_url = os.getenv("RENDER_EXTERNAL_URL", "https://biteiqbot-docker.onrender.com").rstrip("/")
-        webhook_url = f"{base_url}/webhook"
+        webhook_url = f"{settings.render_external_url}/webhook"
+
+        if self.application is None:
+            self.application = self._build_application()
+            self.bot = self.application.bot
+            self._register_handlers()
+
+        # Bring up the Bot's request pools first so the webhook calls below reuse them.
+        await self.application.initialize()
 
         try:
-            await self.application.bot.delete_webhook()
-            await self.application.bot.set_webhook(url=webhook_url, drop_pending_updates=True)
-            _logger.info(f"✅ Telegram webhook set to: {webhook_url}")
+            # Every worker boots through here; only hit setWebhook when the URL changed.
+            # getWebhookInfo never reports the secret token, so a configured secret
+            # always re-registers to be sure Telegram sends the current one.
+            webhook_info = await self.application.bot.get_webhook_info()
+            url_changed = webhook_info.url != webhook_url
+            if url_changed or settings.telegram_webhook_secret:
+                await self.application.bot.set_webhook(
+                    url=webhook_url,
+                    # Re-sending only the secret must not discard updates queued for us.
+                    drop_pending_updates=url_changed,
+                    max_connections=100,
+                    allowed_updates=sorted(HANDLED_UPDATE_TYPES),
+                    secret_token=settings.telegram_webhook_secret,
+                )
+                _logger.info("✅ Telegram webhook set to: %s", webhook_url)
+            else:
+                _logger.info("✅ Telegram webhook already set to: %s", webhook_url)
         except Exception as exc:
-            _logger.warning(f"⚠️ Failed to set Telegram webhook: {exc}")
+            _logger.warning("⚠️ Failed to set Telegram webhook: %s", exc)
 
-        await self.application.initialize()
-        await self.application.start()
+        # A bootstrap retried after a later startup step failed finds it already running.
+        if not self.application.running:
+            await self.application.start()
+
+        self._loop = asyncio.get_running_loop()
         _logger.info("🤖 Telegram bot initialized and ready for webhooks.")
 
+    async def shutdown(self) -> None:
+        await self.application.stop()
+        await self.application.shutdown()
+        _logger.info("🤖 Telegram bot stopped.")
+
+    def enqueue_update_json(self, data: dict[str, Any]) -> bool:
+        """Queue a webhook payload from any thread. Returns False when the queue is full."""
+        if self.application.update_queue.full():
+            return False
+        self._loop.call_soon_threadsafe(self._put_update, data)
+        return True
+
+    def _put_update(self, data: dict[str, Any]) -> None:
+        try:
+            self.application.update_queue.put_nowait(Update.de_json(data, self.bot))
+        except asyncio.QueueFull:
+            _logger.warning("⚠️ Update queue full; dropping update %s", data.get("update_id"))
+
+    async def process_update_json(self, data: dict[str, Any]) -> None:
+        """Deserialize an already-parsed webhook payload and dispatch it."""
+        update = Update.de_json(data, self.bot)
+        await self.application.process_update(update)
+
+    async def warm_up(self) -> None:
+        """Run one synthetic update through parsing and dispatch before real traffic."""
+        await self.process_update_json(_WARMUP_UPDATE)
+
     # --- Handlers ---
     def _register_handlers(self):
         self.application.add_handler(CommandHandler("start", self._start))
         self.application.add_handler(CommandHandler("menu", self._menu))
 
     async def _send_text(
-        self, update: Update, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None
+        self, update: Update, text: str, parse_mode: str | None = None, reply_markup: InlineKeyboardMarkup | None = None
     ):
         chat = update.effective_chat
         if chat:
             await chat.send_message(text=text, parse_mode=parse_mode, reply_markup=reply_markup)
 
     async def _start(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
-        _logger.info(f"👤 Received /start from {update.effective_user.id}")
-        await self._send_text(update, "👋 Welcome to BiteIQBot! The webhook is working ✅")
+        _logger.info("👤 Received /start from %s", update.effective_user.id)
+        await self._send_text(update, _WELCOME_TEXT)
 
     async def _menu(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("ℹ️ Help", callback_data="help")],
-            [InlineKeyboardButton("💳 Subscribe", callback_data="subscribe")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await self._send_text(update, "📋 Menu options:", reply_markup=reply_markup)
-
-
+        await self._send_text(update, _MENU_TEXT, reply_markup=_MENU_MARKUP)